@@ -0,0 +1,189 @@
+"""
+Benchmark of the Lambda's client-side work for one batch, up to the point the data
+leaves the process (network and warehouse time are not included).
+
+- Original path: one dict per payload, a per-payload rain check, and the connector's
+  client-side pyformat binding of every value, which is what cursor.executemany does
+  with the original INSERT ... VALUES (%(column)s, ...) statement.
+- Columnar path: payloads_to_columns, the vectorized rain check, columns_to_frame and
+  the Parquet file write_pandas uploads (snappy, as load_frame_to_snowflake uses).
+
+The binding step needs snowflake-connector-python; without it only the transforms
+are compared.
+
+Run from the repository root:
+    python benchmarks/bench_weather_columns.py [--payloads 20000] [--repeat 7]
+"""
+import argparse
+import gc
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weather_columns import payloads_to_columns, columns_to_frame # noqa: E402
+
+RAIN_KEYWORDS = ["rain", "drizzle", "shower", "thunderstorm", "sleet", "snow"]
+CONDITIONS = ["Sunny", "Partly cloudy", "Light rain shower", "Mist", "Patchy rain nearby", "Overcast"]
+
+
+def make_payload(i: int) -> dict:
+    return {
+        "location": {
+            "name": f"City {i % 50}", "region": "Karnataka", "country": "India",
+            "lat": 12.97, "lon": 77.59, "localtime_epoch": 1718000000 + i, "localtime": "2024-06-10 12:00"
+        },
+        "current": {
+            "last_updated_epoch": 1718000000 + i, "last_updated": "2024-06-10 12:00",
+            "temp_c": round(random.uniform(15, 40), 1), "temp_f": round(random.uniform(59, 104), 1), "is_day": i % 2,
+            "condition": {"text": random.choice(CONDITIONS), "icon": "//cdn.weatherapi.com/weather/64x64/day/113.png", "code": 1000},
+            "wind_kph": 11.2, "wind_mph": 7.0, "wind_degree": 250, "wind_dir": "WSW",
+            "pressure_mb": 1008.0, "pressure_in": 29.77, "precip_mm": random.choice([0.0, 0.0, 0.3]), "precip_in": 0.0,
+            "humidity": random.randint(30, 95), "cloud": random.randint(0, 100),
+            "feelslike_c": 30.1, "feelslike_f": 86.2, "vis_km": 10.0, "vis_miles": 6.0, "uv": 7.0,
+            "gust_kph": 14.5, "gust_mph": 9.0
+        }
+    }
+
+
+def baseline_record(weather_data: dict) -> dict:
+    """The original per-record snowStream.prepare_weather_data_for_snowflake (since replaced by weather_columns), kept as the reference."""
+    location = weather_data.get("location", {})
+    current = weather_data.get("current", {})
+    condition = current.get("condition", {})
+    return {
+        "location_name": location.get("name"),
+        "location_region": location.get("region"),
+        "location_country": location.get("country"),
+        "location_lat": location.get("lat"),
+        "location_lon": location.get("lon"),
+        "localtime_epoch": location.get("localtime_epoch"),
+        "localtime_str": location.get("localtime"),
+        "last_updated_epoch": current.get("last_updated_epoch"),
+        "last_updated_str": current.get("last_updated"),
+        "temp_c": current.get("temp_c"),
+        "temp_f": current.get("temp_f"),
+        "is_day": current.get("is_day") == 1,
+        "condition_text": condition.get("text"),
+        "condition_icon": condition.get("icon"),
+        "condition_code": condition.get("code"),
+        "wind_kph": current.get("wind_kph"),
+        "wind_mph": current.get("wind_mph"),
+        "wind_degree": current.get("wind_degree"),
+        "wind_dir": current.get("wind_dir"),
+        "pressure_mb": current.get("pressure_mb"),
+        "pressure_in": current.get("pressure_in"),
+        "precip_mm": current.get("precip_mm"),
+        "precip_in": current.get("precip_in"),
+        "humidity": current.get("humidity"),
+        "cloud": current.get("cloud"),
+        "feelslike_c": current.get("feelslike_c"),
+        "feelslike_f": current.get("feelslike_f"),
+        "vis_km": current.get("vis_km"),
+        "vis_miles": current.get("vis_miles"),
+        "uv": current.get("uv"),
+        "gust_kph": current.get("gust_kph"),
+        "gust_mph": current.get("gust_mph"),
+        "record_timestamp": datetime.utcnow()
+    }
+
+
+def baseline_raining(weather_data: dict) -> bool:
+    condition_text = weather_data["current"]["condition"]["text"].lower()
+    return any(keyword in condition_text for keyword in RAIN_KEYWORDS) or weather_data["current"]["precip_mm"] > 0.0
+
+
+def columns_raining(columns: dict) -> np.ndarray:
+    """Same as snowStream.is_raining_soon_batch, which cannot be imported without boto3/snowflake."""
+    condition_texts, inverse = np.unique(columns["condition_text"].filled("").astype(str), return_inverse=True)
+    keyword_match = np.array([
+        any(keyword in text.lower() for keyword in RAIN_KEYWORDS) for text in condition_texts
+    ], dtype=bool)
+    return keyword_match[inverse.reshape(-1)] | (columns["precip_mm"].filled(0.0) > 0.0)
+
+
+def pyformat_binder():
+    """
+    Returns the connector's per-value client-side binding (to_snowflake, escape, quote),
+    or None when snowflake-connector-python is not installed.
+    """
+    try:
+        from snowflake.connector._internal.binding_converters import ClientSideBindingConverter
+        return ClientSideBindingConverter.process_single_param
+    except ImportError:
+        pass
+    try:
+        from snowflake.connector.converter import SnowflakeConverter
+        converter = SnowflakeConverter()
+        return lambda value: converter.quote(converter.escape(converter.to_snowflake(value)))
+    except ImportError:
+        return None
+
+
+def best_of(repeat: int, fn) -> float:
+    # Like timeit, keep the garbage collector out of the measurement
+    gc.disable()
+    try:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+    finally:
+        gc.enable()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--payloads", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    random.seed(42)
+    payloads = [make_payload(i) for i in range(args.payloads)]
+    bind = pyformat_binder()
+
+    def baseline():
+        return [baseline_record(p) for p in payloads], [baseline_raining(p) for p in payloads]
+
+    def baseline_bound():
+        records, raining = baseline()
+        values = ",".join("(" + ", ".join(bind(value) for value in record.values()) + ")" for record in records)
+        return values, raining
+
+    def columnar():
+        columns = payloads_to_columns(payloads)
+        return columns, columns_raining(columns)
+
+    def columnar_parquet():
+        columns, raining = columnar()
+        parquet = io.BytesIO()
+        columns_to_frame(columns).to_parquet(parquet, compression="snappy")
+        return parquet, raining
+
+    # Both paths must agree before their timings mean anything
+    records, expected_raining = baseline()
+    columns, raining = columnar()
+    assert raining.tolist() == expected_raining
+    assert columns["humidity"].tolist() == [r["humidity"] for r in records]
+
+    print(f"{args.payloads} payloads, best of {args.repeat}")
+    transform_s = best_of(args.repeat, baseline)
+    elapsed = best_of(args.repeat, columnar)
+    print(f"  transform + rain check             original {transform_s:.4f}s   columnar {elapsed:.4f}s ({transform_s / elapsed:.2f}x)")
+    if bind is None:
+        print("  snowflake-connector-python not installed, skipping the end-to-end comparison")
+        return
+    baseline_s = best_of(args.repeat, baseline_bound)
+    elapsed = best_of(args.repeat, columnar_parquet)
+    print(f"  ... + pyformat binding / Parquet  original {baseline_s:.4f}s   columnar {elapsed:.4f}s ({baseline_s / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import csv
+import math
+import os
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Tuple
+
+# Registry of monitored cities with canonical IDs and coordinates
+CITY_REGISTRY_PATH = os.environ.get(
+    "CITY_REGISTRY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.csv")
+)
+GRID_CELL_DEGREES = 1.0 # Size of the spatial index cells
+EARTH_RADIUS_KM = 6371.0
+
+
+class City(NamedTuple):
+    city_id: str
+    name: str
+    state: str
+    lat: float
+    lon: float
+
+    @property
+    def query(self) -> str:
+        """WeatherAPI `q` value; coordinates avoid server-side name resolution."""
+        return f"{self.lat},{self.lon}"
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Great-circle distance between two points in kilometres.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class CityRegistry:
+    """
+    In-memory city registry with lookups by ID/name/alias, by state, and a
+    fixed-size lat/lon grid for radius queries.
+    """
+    def __init__(self, cities: List[City], aliases: Dict[str, str] | None = None):
+        self.cities = cities
+        self.by_id = {city.city_id: city for city in cities}
+        self.by_key = {}
+        for city in cities:
+            self.by_key[city.city_id.lower()] = city
+            self.by_key[city.name.lower()] = city
+        for alias, city_id in (aliases or {}).items():
+            self.by_key.setdefault(alias.lower(), self.by_id[city_id])
+        self.by_state = defaultdict(list)
+        self.grid = defaultdict(list)
+        for city in cities:
+            self.by_state[city.state.lower()].append(city)
+            self.grid[self._cell(city.lat, city.lon)].append(city)
+
+    @staticmethod
+    def _cell(lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / GRID_CELL_DEGREES), math.floor(lon / GRID_CELL_DEGREES)
+
+    def resolve(self, name: str) -> City | None:
+        """
+        Returns the registered city for an ID, canonical name or alias (case-insensitive).
+        """
+        return self.by_key.get(name.strip().lower())
+
+    def in_state(self, state: str) -> List[City]:
+        return list(self.by_state.get(state.strip().lower(), []))
+
+    def within(self, lat: float, lon: float, radius_km: float) -> List[City]:
+        """
+        Returns the cities within `radius_km` of a point, nearest first. Only the
+        grid cells overlapping the radius' bounding box are scanned.
+        """
+        lat_span = radius_km / 111.0 # ~km per degree of latitude
+        lon_span = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+        min_row, min_col = self._cell(lat - lat_span, lon - lon_span)
+        max_row, max_col = self._cell(lat + lat_span, lon + lon_span)
+        matches = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                for city in self.grid.get((row, col), []):
+                    distance = haversine_km(lat, lon, city.lat, city.lon)
+                    if distance <= radius_km:
+                        matches.append((distance, city))
+        return [city for _, city in sorted(matches)]
+
+
+@lru_cache(maxsize=None)
+def load_city_registry(path: str = CITY_REGISTRY_PATH) -> CityRegistry:
+    """
+    Loads the registry CSV (city_id,name,state,lat,lon,aliases) once per process.
+    Aliases are separated by '|'.
+    """
+    cities = []
+    aliases = {}
+    if not os.path.exists(path):
+        return CityRegistry(cities)
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            city = City(row["city_id"], row["name"], row["state"], float(row["lat"]), float(row["lon"]))
+            cities.append(city)
+            for alias in filter(None, (row.get("aliases") or "").split("|")):
+                aliases[alias] = city.city_id
+    return CityRegistry(cities, aliases)
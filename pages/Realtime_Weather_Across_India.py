@@ -1,4 +1,5 @@
 import streamlit as st
+import json
 import pandas as pd
 import requests
 import plotly.express as px
@@ -6,6 +7,7 @@ import snowflake.connector
 from datetime import datetime
 import pytz
 import boto3
+from weather_cache import load_weather_history
 ist_timezone = pytz.timezone('Asia/Kolkata')
 current_time_ist = datetime.now(ist_timezone)
 current_time_ist = current_time_ist.strftime("%Y-%m-%d %H:%M:%S")
@@ -59,16 +61,22 @@ if st.button("Trigger AWS Lambda to push data to Snowflake"):
         )
         response = lambda_client.invoke(
             FunctionName='snowstream',
-            InvocationType='RequestResponse'
+            InvocationType='RequestResponse',
+            Payload=json.dumps({'force': True})  # On-demand runs refresh every city
         )
         st.success("AWS Lambda function 'snowstream' triggered successfully!")
     except Exception as e:
         st.error(f"Failed to trigger AWS Lambda: {e}")
     st.session_state.weather_data_loaded = True
+    st.session_state.weather_cache_stale = True
 
 if st.session_state.weather_data_loaded:
-    Q1=f'''SELECT * FROM IND_DB.IND_SCH.WEATHER_DATA'''
-    R1 = execute_query(Q1)
+    # Served from the local Parquet cache; Snowflake is only queried for new rows
+    R1 = load_weather_history(
+        'IND_DB.IND_SCH.WEATHER_DATA',
+        execute_query,
+        force_refresh=st.session_state.pop('weather_cache_stale', False)
+    )
     r1_expander = st.expander("Data sets used in this entire analysis.")
     R1_DF = pd.DataFrame(R1)
     R1_DF.index = R1_DF.index + 1
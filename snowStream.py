@@ -1,11 +1,23 @@
 import json
 import os
+import gzip
+import time
+import uuid
+import hashlib
 import logging
+import threading
 import requests
-from datetime import datetime
-from typing import Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from pathlib import Path
+from typing import Dict, Any, List, Set, Tuple
+import numpy as np
+import pandas as pd
 import boto3 # Import boto3 for AWS services like SES and SNS
 import snowflake.connector # Import snowflake connector
+from snowflake.connector.pandas_tools import write_pandas # Needs the connector's [pandas] extra
+from city_registry import load_city_registry
+from weather_columns import TABLE_COLUMNS, ADDED_COLUMNS, payloads_to_columns, columns_to_frame, columns_to_records, records_to_frame
 
 # Configure logging
 logging.basicConfig()
@@ -16,10 +28,53 @@ logger.setLevel(logging.INFO)
 # Weather API Configuration
 WEATHER_API_URL = os.environ.get("WEATHER_API_URL", "http://api.weatherapi.com/v1/current.json" )
 WEATHER_API_KEY = os.environ.get("WEATHER_API_KEY", "YOUR_WEATHER_API_KEY") # Replace with your actual key or env var
+WEATHER_HISTORY_API_URL = os.environ.get("WEATHER_HISTORY_API_URL", "http://api.weatherapi.com/v1/history.json")
+WEATHER_API_RATE_LIMIT_PER_SEC = float(os.environ.get("WEATHER_API_RATE_LIMIT_PER_SEC", "5")) # Shared by all API calls, 0 disables
+WEATHER_API_TIMEOUT_SECONDS = int(os.environ.get("WEATHER_API_TIMEOUT_SECONDS", "10"))
+
+# Backfill Configuration (event payload {"mode": "backfill", ...})
+BACKFILL_MAX_WORKERS = int(os.environ.get("BACKFILL_MAX_WORKERS", "8"))
+BACKFILL_CHUNK_SIZE = int(os.environ.get("BACKFILL_CHUNK_SIZE", "48")) # Max (city, day) tasks per bulk load + checkpoint
+BACKFILL_TIME_RESERVE_MS = int(os.environ.get("BACKFILL_TIME_RESERVE_MS", "30000")) # Kept free for each chunk's load and checkpoint
+
+# Adaptive Scheduling Configuration: stable cities are refreshed less often
+ADAPTIVE_SCHEDULING = os.environ.get("ADAPTIVE_SCHEDULING", "true").lower() == "true"
+SCHEDULER_MAX_INTERVAL_TICKS = int(os.environ.get("SCHEDULER_MAX_INTERVAL_TICKS", "3")) # Bounds how late a rain alert can be
+SCHEDULER_TEMP_DELTA_C = float(os.environ.get("SCHEDULER_TEMP_DELTA_C", "1.5")) # Change that counts as volatile
+SCHEDULER_PRECIP_DELTA_MM = float(os.environ.get("SCHEDULER_PRECIP_DELTA_MM", "0.1"))
+# Leading signals of rain: a city showing any of these is fetched on every tick
+SCHEDULER_HUMIDITY_RISE = int(os.environ.get("SCHEDULER_HUMIDITY_RISE", "5")) # Percentage points since the last fetch
+SCHEDULER_CLOUD_RISE = int(os.environ.get("SCHEDULER_CLOUD_RISE", "15"))
+SCHEDULER_HUMIDITY_HIGH = int(os.environ.get("SCHEDULER_HUMIDITY_HIGH", "85"))
+
+# Per-city state (scheduler, anomaly statistics) not refreshed for this long is dropped,
+# so cities that are only monitored by occasional scoped runs keep theirs
+STATE_MAX_AGE_DAYS = int(os.environ.get("STATE_MAX_AGE_DAYS", "30"))
+
+# Keywords that might indicate rain or precipitation
+RAIN_KEYWORDS = ["rain", "drizzle", "shower", "thunderstorm", "sleet", "snow"]
+
+# Anomaly Detection Configuration: per-city running mean/variance, persisted between runs
+ANOMALY_DETECTION = os.environ.get("ANOMALY_DETECTION", "true").lower() == "true"
+ANOMALY_Z_THRESHOLD = float(os.environ.get("ANOMALY_Z_THRESHOLD", "3.0"))
+ANOMALY_MIN_SAMPLES = int(os.environ.get("ANOMALY_MIN_SAMPLES", "24")) # Observations before a city is scored
+ANOMALY_WINDOW = int(os.environ.get("ANOMALY_WINDOW", "720")) # Beyond this the statistics become an EWMA
+# Smallest standard deviation used per field, so near-constant series (e.g. dry-season
+# precipitation) do not flag every tiny change
+ANOMALY_MIN_STD = {
+    "temp_c": 0.5,
+    "wind_kph": 2.0,
+    "gust_kph": 3.0,
+    "pressure_mb": 1.0,
+    "precip_mm": 0.5
+}
 
 # List of cities to monitor, comma-separated from environment variable
 CITIES_TO_MONITOR_STR = os.environ.get("CITIES_TO_MONITOR", "Bengaluru,Mumbai,Delhi,Chennai") # Default Indian cities
 CITIES_TO_MONITOR = [city.strip() for city in CITIES_TO_MONITOR_STR.split(",") if city.strip()]
+# Registered cities (data/cities.csv, or CITY_REGISTRY_PATH) are queried by coordinates
+# and stored under their canonical name; unregistered names are sent to the API as-is.
+city_registry = load_city_registry()
 
 # SES Email Configuration
 SENDER_EMAIL = os.environ.get("SENDER_EMAIL", "your-verified-sender-email@example.com") # !!! IMPORTANT: Replace with your SES verified sender email !!!
@@ -34,31 +89,99 @@ SNOWFLAKE_WAREHOUSE = os.environ.get("SNOWFLAKE_WAREHOUSE")
 SNOWFLAKE_DATABASE = os.environ.get("SNOWFLAKE_DATABASE")
 SNOWFLAKE_SCHEMA = os.environ.get("SNOWFLAKE_SCHEMA")
 SNOWFLAKE_TABLE = os.environ.get("SNOWFLAKE_TABLE", "weather_data") # Default table name
+SNOWFLAKE_STAGE_TABLE = "weather_data_load_stage" # Session-scoped temporary table every load goes through
+
+# Durable store for batches that could not be written to Snowflake and for
+# small state documents (backfill checkpoints, scheduler state).
+# Defaults to the Lambda's /tmp (survives only while the container is warm); set
+# S3_STORE_BUCKET to keep it in S3 or an S3-compatible store such as MinIO.
+LOCAL_STORE_DIR = os.environ.get("LOCAL_STORE_DIR", "/tmp/snowstream")
+S3_STORE_BUCKET = os.environ.get("S3_STORE_BUCKET")
+S3_STORE_PREFIX = os.environ.get("S3_STORE_PREFIX", "snowstream/")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") # e.g. http://localhost:9000 for a local stand-in
+SPOOL_MAX_BATCHES = int(os.environ.get("SPOOL_MAX_BATCHES", "500"))
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", str(50 * 1024 * 1024)))
+SPOOL_DRAIN_MAX_BATCHES = int(os.environ.get("SPOOL_DRAIN_MAX_BATCHES", "50")) # Spooled batches inserted per invocation
+SPOOL_MAX_ATTEMPTS = int(os.environ.get("SPOOL_MAX_ATTEMPTS", "3")) # Failed inserts before a batch is dead-lettered
+SPOOL_MAX_DEAD_BATCHES = int(os.environ.get("SPOOL_MAX_DEAD_BATCHES", "100"))
+SPOOL_PREFIX = "spool/"
+SPOOL_DEAD_PREFIX = "spool/dead/"
+STATE_PREFIX = "state/"
 
 # Initialize AWS clients
 ses_client = boto3.client("ses", region_name=os.environ.get("AWS_REGION", "us-east-1"))
+s3_client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL) if S3_STORE_BUCKET else None
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces calls out to at most `rate_per_sec`.
+    """
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+weather_api_limiter = RateLimiter(WEATHER_API_RATE_LIMIT_PER_SEC)
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Main Lambda handler function for weather monitoring, rain notification,
     and storing weather data in Snowflake for multiple cities.
     This function is designed to be triggered by a scheduled EventBridge rule.
+    An event with "mode": "backfill" runs run_backfill instead, and an event with
+    "force": true refreshes every city regardless of the adaptive schedule.
+    The cities to process can be scoped by the event, see select_cities.
     """
-    all_weather_records_for_snowflake = [] # NEW: List to collect all records
+    if (event or {}).get("mode") == "backfill":
+        return run_backfill(event, context)
+
+    try:
+        cities = select_cities(event)
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"message": f"Invalid city scope: {str(e)}"})
+        }
+
+    fetched_cities = [] # Cities fetched on this run, aligned with weather_payloads
+    weather_payloads = []
     all_messages = []
 
-    # Ensure Snowflake table exists before processing any data
+    # Ensure Snowflake table exists before processing any data.
+    # If Snowflake is unreachable we still collect the data and spool it.
+    snowflake_available = True
     try:
-        ensure_snowflake_table_exists()
+        table_columns = ensure_snowflake_table_exists()
         logger.info(f"Snowflake table {SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{SNOWFLAKE_TABLE} ensured to exist.")
+        missing_columns = [name for name, _ in TABLE_COLUMNS if name not in table_columns]
+        if missing_columns:
+            all_messages.append(f"Snowflake table is missing column(s) {', '.join(missing_columns)}, loading without them.")
     except Exception as e:
         logger.error(f"Failed to ensure Snowflake table exists: {str(e)}")
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"message": f"Failed to initialize Snowflake table: {str(e)}"})
-        }
+        all_messages.append(f"Snowflake unavailable: {str(e)}.")
+        snowflake_available = False
+
+    schedule_state = load_state("scheduler") if ADAPTIVE_SCHEDULING else {}
+    force_refresh = bool((event or {}).get("force"))
+    now_epoch = int(time.time())
+    skipped_cities = []
+    anomaly_state = load_state("anomaly_stats") if ANOMALY_DETECTION else {}
+
+    for city in cities:
+        if ADAPTIVE_SCHEDULING and not force_refresh and not is_city_due(schedule_state.get(city)):
+            logger.info(f"Skipping {city}, stable and not due for a refresh yet.")
+            schedule_state[city]["skipped_ticks"] = schedule_state[city].get("skipped_ticks", 0) + 1
+            skipped_cities.append(city)
+            continue
 
-    for city in CITIES_TO_MONITOR:
         logger.info(f"Processing weather data for city: {city}...")
         try:
             weather_data = fetch_weather_data(city)
@@ -72,34 +195,81 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             current_temp_c = weather_data["current"]["temp_c"]
             logger.info(f"Current weather in {city}: {current_condition_text}, Temp: {current_temp_c}°C")
 
+            fetched_cities.append(city)
+            weather_payloads.append(weather_data)
+
+        except Exception as e:
+            logger.error(f"Unhandled error processing {city}: {str(e)}")
+            all_messages.append(f"Unhandled error for {city}: {str(e)}.")
+
+    # --- Transform and score all fetched payloads in one columnar pass ---
+    weather_columns = payloads_to_columns(weather_payloads)
+    raining = is_raining_soon_batch(weather_columns)
+    if ANOMALY_DETECTION:
+        anomalies = detect_anomalies_batch(anomaly_state, fetched_cities, weather_columns)
+        anomaly_flags = [format_anomaly_flags(city_anomalies) for city_anomalies in anomalies]
+        weather_columns["anomaly_flags"] = np.ma.masked_array(
+            np.array(anomaly_flags, dtype=object), mask=[flags is None for flags in anomaly_flags]
+        )
+    else:
+        anomalies = [{} for _ in fetched_cities]
+
+    for i, (city, weather_data) in enumerate(zip(fetched_cities, weather_payloads)):
+        try:
             # --- Notification Logic ---
             notification_message = f"No rain expected for {city} at the moment."
-            if is_raining_soon(weather_data):
+            if raining[i]:
                 logger.info(f"Rain is expected for {city}! Sending notifications.")
                 send_notifications(weather_data) # This function now handles city-specific alerts
                 notification_message = f"Rain notifications sent for {city}!"
             
             all_messages.append(notification_message)
 
-            # --- Prepare Data for Batch Snowflake Insert ---
-            snowflake_record = prepare_weather_data_for_snowflake(weather_data)
-            all_weather_records_for_snowflake.append(snowflake_record) # NEW: Add to list
+            if ADAPTIVE_SCHEDULING:
+                schedule_state[city] = update_city_schedule(schedule_state.get(city), weather_data, bool(raining[i]), now_epoch)
+
+            if anomalies[i]:
+                flags = format_anomaly_flags(anomalies[i])
+                logger.info(f"Anomalies detected for {city}: {flags}")
+                send_anomaly_email_notification(weather_data, anomalies[i])
+                all_messages.append(f"Anomaly alert sent for {city} ({flags}).")
 
         except Exception as e:
             logger.error(f"Unhandled error processing {city}: {str(e)}")
             all_messages.append(f"Unhandled error for {city}: {str(e)}.")
 
-    # --- NEW: Perform Batch Snowflake Insert AFTER the loop ---
+    if ADAPTIVE_SCHEDULING:
+        save_state("scheduler", prune_city_state(schedule_state, "last_fetched_epoch", now_epoch))
+    if ANOMALY_DETECTION:
+        save_state("anomaly_stats", prune_city_state(anomaly_state, "last_updated_epoch", now_epoch))
+    if skipped_cities:
+        all_messages.append(f"Skipped {len(skipped_cities)} stable city(ies) not yet due: {', '.join(skipped_cities)}.")
+
+    # --- Perform Batch Snowflake Insert AFTER the loop, then drain spooled batches separately ---
     total_records_inserted = 0
-    if all_weather_records_for_snowflake:
-        try:
-            total_records_inserted = insert_to_snowflake(all_weather_records_for_snowflake)
-            logger.info(f"Successfully inserted {total_records_inserted} weather record(s) into Snowflake in batch.")
-        except Exception as e:
-            logger.error(f"Error inserting batch data to Snowflake: {str(e)}")
-            all_messages.append(f"Failed to insert batch data to Snowflake: {str(e)}.")
+    if snowflake_available:
+        live_insert_failed = False
+        if fetched_cities:
+            try:
+                total_records_inserted = load_frame_to_snowflake(columns_to_frame(weather_columns), table_columns)
+                logger.info(f"Successfully inserted {total_records_inserted} weather record(s) into Snowflake in batch.")
+            except Exception as e:
+                logger.error(f"Error inserting batch data to Snowflake: {str(e)}")
+                all_messages.append(f"Failed to insert batch data to Snowflake: {str(e)}.")
+                spool_weather_records(columns_to_records(weather_columns))
+                live_insert_failed = True
+        else:
+            logger.info("No weather records collected for Snowflake insertion.")
+
+        # Only drain when Snowflake just accepted writes, so an outage is not counted
+        # against the spooled batches' attempts
+        if not live_insert_failed:
+            drained_batches, drained_records = drain_spooled_batches(table_columns)
+            total_records_inserted += drained_records
+            if drained_batches:
+                all_messages.append(f"Drained {drained_batches} spooled batch(es).")
     else:
-        logger.info("No weather records collected for Snowflake insertion.")
+        spool_weather_records(columns_to_records(weather_columns))
 
     return {
         "statusCode": 200,
@@ -109,46 +279,208 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         })
     }
 
+def select_cities(event: Dict[str, Any] | None) -> List[str]:
+    """
+    Returns the cities for this run: an explicit "cities" list, all registered
+    cities of a "state", or those within "near": {"lat", "lon", "radius_km"} of a
+    point. Without any of these it falls back to CITIES_TO_MONITOR.
+    "cities" may be a list of names or a comma-separated string. Raises ValueError
+    for a malformed scope.
+
+    Cities are returned as their keys (see city_key), without duplicates, so the
+    scheduler, anomaly and backfill state of a city is the same however it was named.
+    """
+    event = event or {}
+    cities = event.get("cities")
+    if cities:
+        if isinstance(cities, str):
+            cities = cities.split(",")
+        if not isinstance(cities, list) or not all(isinstance(city, str) for city in cities):
+            raise ValueError("\"cities\" must be a city name or a list of city names")
+        return list(dict.fromkeys(city_key(city) for city in cities if city.strip()))
+    state = event.get("state")
+    if state:
+        if not isinstance(state, str):
+            raise ValueError("\"state\" must be a state name")
+        return [city.city_id for city in city_registry.in_state(state)]
+    near = event.get("near")
+    if near:
+        if not isinstance(near, dict):
+            raise ValueError("\"near\" must be an object with lat, lon and an optional radius_km")
+        lat, lon, radius_km = near.get("lat"), near.get("lon"), near.get("radius_km", 100)
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in (lat, lon, radius_km)):
+            raise ValueError("\"near\" needs numeric lat and lon (and radius_km if given)")
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180 and radius_km > 0):
+            raise ValueError("\"near\" lat/lon out of range or radius_km not positive")
+        return [city.city_id for city in city_registry.within(lat, lon, radius_km)]
+    return list(dict.fromkeys(city_key(city) for city in CITIES_TO_MONITOR))
+
+def city_key(city: str) -> str:
+    """
+    Returns the key a city's state is stored under: the registry city_id when the
+    name, ID or alias is registered, else the stripped name itself.
+    """
+    registered = city_registry.resolve(city)
+    return registered.city_id if registered else city.strip()
+
+def prune_city_state(state: Dict[str, Dict[str, Any]], epoch_field: str, now_epoch: int) -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the per-city state without the entries whose `epoch_field` is more than
+    STATE_MAX_AGE_DAYS old (entries without it are kept). Entries stored under a name
+    that now resolves to another key, e.g. an alias registered since, move to that key
+    unless it already has state of its own.
+    """
+    oldest_epoch = now_epoch - STATE_MAX_AGE_DAYS * 86400
+    pruned = {}
+    # Entries already under their key go first, so they win over a stale alias
+    for city, city_state in sorted(state.items(), key=lambda item: city_key(item[0]) != item[0]):
+        epoch = city_state.get(epoch_field)
+        if epoch is not None and epoch < oldest_epoch:
+            continue
+        pruned.setdefault(city_key(city), city_state)
+    return pruned
+
+def weather_query(city: str) -> str:
+    """
+    Returns the WeatherAPI `q` value for a city: "lat,lon" when registered, else the name.
+    """
+    registered = city_registry.resolve(city)
+    return registered.query if registered else city
+
+def canonicalize_location(weather_data: Dict[str, Any], city: str) -> Dict[str, Any]:
+    """
+    Overwrites the API's location name/region with the registry's canonical values,
+    so the same city is always stored under the same location_name. Raises ValueError
+    when the response body is not a JSON object.
+    """
+    if not isinstance(weather_data, dict):
+        raise ValueError(f"expected a JSON object, got {type(weather_data).__name__}")
+    registered = city_registry.resolve(city)
+    if registered:
+        location = weather_data.setdefault("location", {})
+        location["name"] = registered.name
+        location["region"] = registered.state
+    return weather_data
+
 def fetch_weather_data(city: str) -> Dict[str, Any] | None:
     """
     Fetches current weather data from the WeatherAPI.
     """
     params = {
-        "q": city,
+        "q": weather_query(city),
         "key": WEATHER_API_KEY
     }
     try:
-        response = requests.get(WEATHER_API_URL, params=params, timeout=10)
+        weather_api_limiter.wait()
+        response = requests.get(WEATHER_API_URL, params=params, timeout=WEATHER_API_TIMEOUT_SECONDS)
         response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        return canonicalize_location(response.json(), city)
+    except (requests.exceptions.RequestException, ValueError) as e: # ValueError: body is not a JSON object
         logger.error(f"Error fetching weather data for {city}: {e}")
         return None
 
-def is_raining_soon(weather_data: Dict[str, Any]) -> bool:
+def fetch_history_data(city: str, day: date) -> Dict[str, Any] | None:
     """
-    Checks if the current weather condition indicates rain.
-    This is a simplified check based on current conditions. For more accuracy,
-    you'd typically use forecast data and more sophisticated logic.
+    Fetches hourly weather history for one city and day from the WeatherAPI.
     """
-    condition_text = weather_data["current"]["condition"]["text"].lower()
-    precip_mm = weather_data["current"]["precip_mm"]
+    params = {
+        "q": weather_query(city),
+        "dt": day.isoformat(),
+        "key": WEATHER_API_KEY
+    }
+    try:
+        weather_api_limiter.wait()
+        response = requests.get(WEATHER_HISTORY_API_URL, params=params, timeout=WEATHER_API_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        return canonicalize_location(response.json(), city)
+    except (requests.exceptions.RequestException, ValueError) as e: # ValueError: body is not a JSON object
+        logger.error(f"Error fetching weather history for {city} on {day}: {e}")
+        return None
 
-    # Keywords that might indicate rain or precipitation
-    rain_keywords = ["rain", "drizzle", "shower", "thunderstorm", "sleet", "snow"]
+def is_raining_soon_batch(weather_columns: Dict[str, np.ma.MaskedArray]) -> np.ndarray:
+    """
+    Checks, for every row of the columns from payloads_to_columns, if the current
+    condition indicates rain: a rain keyword in the condition text, or any recorded
+    precipitation. This is a simplified check based on current conditions; for more
+    accuracy you'd typically use forecast data. Condition texts repeat a lot, so the
+    keywords are only matched against each distinct text.
+    Returns a boolean array, one entry per row.
+    """
+    condition_texts, inverse = np.unique(weather_columns["condition_text"].filled("").astype(str), return_inverse=True)
+    matched_keywords = [
+        next((keyword for keyword in RAIN_KEYWORDS if keyword in text.lower()), None) for text in condition_texts
+    ]
+    inverse = inverse.reshape(-1)
+    keyword_match = np.array([keyword is not None for keyword in matched_keywords], dtype=bool)[inverse]
+    precip_mm = weather_columns["precip_mm"].filled(0.0)
+    raining = keyword_match | (precip_mm > 0.0)
 
-    # Check condition text for rain keywords
-    for keyword in rain_keywords:
-        if keyword in condition_text:
-            logger.info(f"Rain detected by keyword: \'{keyword}\' in \'{condition_text}\'")
-            return True
+    for i in np.flatnonzero(raining):
+        if keyword_match[i]:
+            condition_text = condition_texts[inverse[i]].lower()
+            logger.info(f"Rain detected by keyword: \'{matched_keywords[inverse[i]]}\' in \'{condition_text}\'")
+        else:
+            logger.info(f"Rain detected by precipitation (precip_mm > 0): {precip_mm[i]}mm")
+    return raining
 
-    # Check for non-zero precipitation (even a small amount)
-    if precip_mm > 0.0: # Check if there's any recorded precipitation
-        logger.info(f"Rain detected by precipitation (precip_mm > 0): {precip_mm}mm")
+def is_city_due(city_schedule: Dict[str, Any] | None) -> bool:
+    """
+    Decides whether a city should be fetched on this tick. Unknown, raining and
+    every-tick cities are always due; others are due once they have been skipped
+    `interval` - 1 times since their last fetch. Ticks are counted rather than timed,
+    so the schedule does not depend on the EventBridge period.
+    """
+    if not city_schedule or city_schedule.get("raining"):
         return True
+    interval = city_schedule.get("interval", 1)
+    return interval <= 1 or city_schedule.get("skipped_ticks", 0) + 1 >= interval
+
+def update_city_schedule(city_schedule: Dict[str, Any] | None, weather_data: Dict[str, Any], raining: bool, now_epoch: int) -> Dict[str, Any]:
+    """
+    Updates a city's refresh interval (in ticks) from its latest observation.
+    Raining cities, cities whose temperature or precipitation moved noticeably and
+    cities showing leading signals of rain (humidity or cloud cover rising, or high
+    humidity) go back to every tick; otherwise the interval doubles up to the
+    maximum. A city whose last_updated_epoch did not change also backs off, since
+    the API had nothing new for it.
+    """
+    current = weather_data.get("current", {})
+    temp_c = current.get("temp_c")
+    precip_mm = current.get("precip_mm")
+    humidity = current.get("humidity")
+    cloud = current.get("cloud")
+    last_updated_epoch = current.get("last_updated_epoch")
 
-    return False
+    interval = 1
+    if city_schedule and not raining:
+        previous_temp_c = city_schedule.get("temp_c")
+        previous_precip_mm = city_schedule.get("precip_mm")
+        volatile = (
+            temp_c is None or previous_temp_c is None
+            or abs(temp_c - previous_temp_c) >= SCHEDULER_TEMP_DELTA_C
+            or abs((precip_mm or 0.0) - (previous_precip_mm or 0.0)) >= SCHEDULER_PRECIP_DELTA_MM
+        )
+        previous_humidity = city_schedule.get("humidity")
+        previous_cloud = city_schedule.get("cloud")
+        rain_building = (
+            (humidity is not None and humidity >= SCHEDULER_HUMIDITY_HIGH)
+            or (humidity is not None and previous_humidity is not None and humidity - previous_humidity >= SCHEDULER_HUMIDITY_RISE)
+            or (cloud is not None and previous_cloud is not None and cloud - previous_cloud >= SCHEDULER_CLOUD_RISE)
+        )
+        if not rain_building and (city_schedule.get("last_updated_epoch") == last_updated_epoch or not volatile):
+            interval = min(city_schedule.get("interval", 1) * 2, SCHEDULER_MAX_INTERVAL_TICKS)
+
+    return {
+        "interval": interval,
+        "skipped_ticks": 0,
+        "last_fetched_epoch": now_epoch,
+        "last_updated_epoch": last_updated_epoch,
+        "temp_c": temp_c,
+        "precip_mm": precip_mm,
+        "humidity": humidity,
+        "cloud": cloud,
+        "raining": raining
+    }
 
 def send_email_notification(weather_data: Dict[str, Any]):
     """
@@ -179,7 +511,37 @@ It looks like it's about to rain or is currently raining. Don't forget your umbr
 Best regards,
 Your Weather Notifier
 """
+    send_ses_email(subject, body_text)
+
+def send_anomaly_email_notification(weather_data: Dict[str, Any], anomalies: Dict[str, float]):
+    """
+    Sends an email listing the readings that deviate from the city's usual values.
+    """
+    location_name = weather_data["location"]["name"]
+    last_updated = weather_data["current"].get("last_updated")
+    anomaly_lines = "\n".join(
+        f"- {field}: {weather_data['current'].get(field)} (z-score {z_score:+.1f})"
+        for field, z_score in anomalies.items()
+    )
+
+    subject = f"Unusual Weather Alert for {location_name}!"
+    body_text = f"""
+Hello,
 
+This is an automated alert for unusual weather readings in {location_name}.
+
+Readings outside the usual range (as of {last_updated}):
+{anomaly_lines}
+
+Best regards,
+Your Weather Notifier
+"""
+    send_ses_email(subject, body_text)
+
+def send_ses_email(subject: str, body_text: str):
+    """
+    Sends a plain-text email using AWS SES to all configured recipients.
+    """
     if not RECIPIENT_EMAILS:
         logger.warning("No recipient emails configured. Skipping email notification.")
         return
@@ -212,52 +574,87 @@ def send_notifications(weather_data: Dict[str, Any]):
     Orchestrates sending all types of notifications.
     """
     send_email_notification(weather_data)
+
+def detect_anomalies_batch(anomaly_state: Dict[str, Dict[str, List[float]]], city_keys: List[str], weather_columns: Dict[str, np.ma.MaskedArray]) -> List[Dict[str, float]]:
+    """
+    Scores each row against its city's running statistics and then folds it in.
+
+    `anomaly_state` maps city -> field -> [count, mean, variance], plus the
+    last_updated_epoch folded in, and is updated in place; `city_keys` names the city
+    of each row and must not repeat. A row whose last_updated_epoch was already folded
+    in (the API had no new observation) is neither scored nor folded in again. The
+    update uses weight 1/count, which gives the exact mean and population variance
+    (Welford) until ANOMALY_WINDOW observations and an EWMA after. Returns, per row,
+    {field: z_score} for fields at or beyond ANOMALY_Z_THRESHOLD.
+    """
+    anomalies = [{} for _ in city_keys]
+    if not city_keys:
+        return anomalies
+    city_states = [anomaly_state.setdefault(city, {}) for city in city_keys]
+    epochs = weather_columns["last_updated_epoch"]
+    epoch_known = ~np.ma.getmaskarray(epochs)
+    seen = np.array([city_state.get("last_updated_epoch") for city_state in city_states], dtype=object)
+    new_observation = ~(epoch_known & (seen == epochs.filled(0).astype(object)))
+    for field, min_std in ANOMALY_MIN_STD.items():
+        stats = np.array([city_state.get(field, [0, 0.0, 0.0]) for city_state in city_states], dtype=float)
+        count, mean, variance = stats[:, 0], stats[:, 1], stats[:, 2]
+        present = ~np.ma.getmaskarray(weather_columns[field]) & new_observation
+        values = weather_columns[field].filled(0.0).astype(float)
+
+        z_scores = (values - mean) / np.maximum(np.sqrt(variance), min_std)
+        flagged = present & (count >= ANOMALY_MIN_SAMPLES) & (np.abs(z_scores) >= ANOMALY_Z_THRESHOLD)
+        for i in np.flatnonzero(flagged):
+            anomalies[i][field] = round(float(z_scores[i]), 2)
+
+        count = np.minimum(count + 1, ANOMALY_WINDOW)
+        weight = 1.0 / count
+        delta = values - mean
+        mean = mean + weight * delta
+        variance = (1.0 - weight) * (variance + weight * delta * delta)
+        for i in np.flatnonzero(present):
+            city_states[i][field] = [int(count[i]), round(float(mean[i]), 4), round(float(variance[i]), 4)]
+    for i in np.flatnonzero(new_observation & epoch_known):
+        city_states[i]["last_updated_epoch"] = int(epochs[i])
+    return anomalies
+
+def format_anomaly_flags(anomalies: Dict[str, float]) -> str | None:
+    """
+    Formats anomalies for the anomaly_flags column, e.g. "temp_c:+3.4,wind_kph:+5.1".
+    """
+    if not anomalies:
+        return None
+    return ",".join(f"{field}:{z_score:+.1f}" for field, z_score in anomalies.items())
  
 
-def prepare_weather_data_for_snowflake(weather_data: Dict[str, Any]) -> Dict[str, Any]:
+def history_to_hourly_payloads(history_data: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
-    Transforms the fetched weather data into a format suitable for Snowflake insertion.
-    Matches the proposed Snowflake table schema.
+    Presents each hour of a history.json response as a current.json-style payload,
+    so hourly history goes through the same transform as live data.
     """
-    location = weather_data.get("location", {})
-    current = weather_data.get("current", {})
-    condition = current.get("condition", {})
+    location = history_data.get("location", {})
+    payloads = []
+    for forecast_day in history_data.get("forecast", {}).get("forecastday", []):
+        for hour in forecast_day.get("hour", []):
+            payloads.append({
+                "location": {**location, "localtime_epoch": hour.get("time_epoch"), "localtime": hour.get("time")},
+                "current": {**hour, "last_updated_epoch": hour.get("time_epoch"), "last_updated": hour.get("time")}
+            })
+    return payloads
 
-    return {
-        "location_name": location.get("name"),
-        "location_region": location.get("region"),
-        "location_country": location.get("country"),
-        "location_lat": location.get("lat"),
-        "location_lon": location.get("lon"),
-        "localtime_epoch": location.get("localtime_epoch"),
-        "localtime_str": location.get("localtime"),
-        "last_updated_epoch": current.get("last_updated_epoch"),
-        "last_updated_str": current.get("last_updated"),
-        "temp_c": current.get("temp_c"),
-        "temp_f": current.get("temp_f"),
-        "is_day": current.get("is_day") == 1, # Convert 1/0 to True/False
-        "condition_text": condition.get("text"),
-        "condition_icon": condition.get("icon"),
-        "condition_code": condition.get("code"),
-        "wind_kph": current.get("wind_kph"),
-        "wind_mph": current.get("wind_mph"),
-        "wind_degree": current.get("wind_degree"),
-        "wind_dir": current.get("wind_dir"), # Corrected: wind_dir is under current
-        "pressure_mb": current.get("pressure_mb"),
-        "pressure_in": current.get("pressure_in"),
-        "precip_mm": current.get("precip_mm"),
-        "precip_in": current.get("precip_in"),
-        "humidity": current.get("humidity"),
-        "cloud": current.get("cloud"),
-        "feelslike_c": current.get("feelslike_c"),
-        "feelslike_f": current.get("feelslike_f"),
-        "vis_km": current.get("vis_km"),
-        "vis_miles": current.get("vis_miles"),
-        "uv": current.get("uv"),
-        "gust_kph": current.get("gust_kph"),
-        "gust_mph": current.get("gust_mph"),
-        "record_timestamp": datetime.utcnow() # Timestamp when this record is processed by Lambda
-    }
+def fetch_backfill_task(city: str, day: date) -> List[Dict[str, Any]] | None:
+    """
+    Fetches one (city, day) backfill task and flattens it into hourly payloads.
+    Returns None when the task failed, including a response that is not shaped like
+    history.json, so one bad task cannot abort the backfill.
+    """
+    try:
+        history_data = fetch_history_data(city, day)
+        if not history_data:
+            return None
+        return history_to_hourly_payloads(history_data)
+    except Exception as e:
+        logger.error(f"Malformed weather history for {city} on {day}: {str(e)}")
+        return None
 
 def get_snowflake_connection():
     """
@@ -278,9 +675,14 @@ def get_snowflake_connection():
         logger.error(f"Failed to connect to Snowflake: {str(e)}")
         raise
 
-def ensure_snowflake_table_exists():
+def ensure_snowflake_table_exists() -> Set[str]:
     """
     Checks if the Snowflake table exists and creates it if it doesn't.
+    Columns added after the table was first created are only ALTERed in when
+    INFORMATION_SCHEMA shows them missing, so the migration runs once. A failed
+    migration (e.g. a role without OWNERSHIP of the table) is logged but not raised:
+    the table stays usable and loads skip the missing columns.
+    Returns the (lowercase) names of the columns the table has.
     """
     conn = None
     cursor = None
@@ -288,48 +690,44 @@ def ensure_snowflake_table_exists():
         conn = get_snowflake_connection()
         cursor = conn.cursor()
 
-        # SQL to create the table if it doesn't exist
+        # SQL to create the table if it doesn't exist, from the shared column specs
+        column_definitions = ",\n            ".join(f"{name} {sql_type}" for name, sql_type in TABLE_COLUMNS)
         create_table_sql = f"""
         CREATE TABLE IF NOT EXISTS {SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{SNOWFLAKE_TABLE} (
-            location_name VARCHAR,
-            location_region VARCHAR,
-            location_country VARCHAR,
-            location_lat FLOAT,
-            location_lon FLOAT,
-            localtime_epoch BIGINT,
-            localtime_str VARCHAR,
-            last_updated_epoch BIGINT,
-            last_updated_str VARCHAR,
-            temp_c FLOAT,
-            temp_f FLOAT,
-            is_day BOOLEAN,
-            condition_text VARCHAR,
-            condition_icon VARCHAR,
-            condition_code INTEGER,
-            wind_kph FLOAT,
-            wind_mph FLOAT,
-            wind_degree INTEGER,
-            wind_dir VARCHAR,
-            pressure_mb FLOAT,
-            pressure_in FLOAT,
-            precip_mm FLOAT,
-            precip_in FLOAT,
-            humidity INTEGER,
-            cloud INTEGER,
-            feelslike_c FLOAT,
-            feelslike_f FLOAT,
-            vis_km FLOAT,
-            vis_miles FLOAT,
-            uv FLOAT,
-            gust_kph FLOAT,
-            gust_mph FLOAT,
-            record_timestamp TIMESTAMP_NTZ
+            {column_definitions}
         );
         """
         logger.info(f"Executing CREATE TABLE IF NOT EXISTS for {SNOWFLAKE_TABLE}")
         cursor.execute(create_table_sql)
         logger.info(f"Table {SNOWFLAKE_TABLE} creation command executed.")
 
+        cursor.execute(
+            f"SELECT LOWER(column_name) FROM {SNOWFLAKE_DATABASE}.INFORMATION_SCHEMA.COLUMNS "
+            f"WHERE table_schema = UPPER(%s) AND table_name = UPPER(%s)",
+            (SNOWFLAKE_SCHEMA, SNOWFLAKE_TABLE)
+        )
+        table_columns = {row[0] for row in cursor.fetchall()}
+        if not table_columns:
+            # The role cannot see the table's metadata; assume it is up to date
+            logger.warning(f"No columns of {SNOWFLAKE_TABLE} visible in INFORMATION_SCHEMA, assuming the full schema.")
+            return {name for name, _ in TABLE_COLUMNS}
+
+        # Columns added after the table was first created
+        column_types = dict(TABLE_COLUMNS)
+        for name in ADDED_COLUMNS:
+            if name in table_columns:
+                continue
+            try:
+                cursor.execute(
+                    f"ALTER TABLE {SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{SNOWFLAKE_TABLE} "
+                    f"ADD COLUMN IF NOT EXISTS {name} {column_types[name]}"
+                )
+                table_columns.add(name)
+                logger.info(f"Added column {name} to {SNOWFLAKE_TABLE}.")
+            except Exception as e:
+                logger.error(f"Failed to add column {name} to {SNOWFLAKE_TABLE}, loading without it: {str(e)}")
+        return table_columns
+
     except Exception as e:
         logger.error(f"Error ensuring Snowflake table exists: {str(e)}")
         raise
@@ -339,35 +737,68 @@ def ensure_snowflake_table_exists():
         if conn:
             conn.close()
 
-def insert_to_snowflake(weather_records: List[Dict[str, Any]]) -> int:
+def load_frame_to_snowflake(frame: pd.DataFrame, table_columns: Set[str], dedupe: bool = False) -> int:
     """
-    Insert weather data records into Snowflake.
+    Bulk-loads a DataFrame into the weather table. write_pandas uploads it as Parquet
+    into a session-scoped staging table (PUT + COPY), so values are never bound row by
+    row on the client; one INSERT ... SELECT then moves the rows into the table.
+    With `dedupe` (backfill), a MERGE inserts only the (location_name,
+    last_updated_epoch) pairs the table does not hold yet, so a chunk re-run after a
+    failed checkpoint does not duplicate rows. Columns missing from the frame (e.g. in
+    batches spooled before they were added) are loaded as NULL; columns missing from
+    the table (`table_columns`, see ensure_snowflake_table_exists) are left out.
+    Returns the number of rows inserted.
     """
-    if not weather_records:
+    if frame.empty:
         logger.warning("No weather data to insert into Snowflake.")
         return 0
+    frame = frame[[column for column in frame.columns if column in table_columns]]
 
     conn = None
     cursor = None
     try:
         conn = get_snowflake_connection()
         cursor = conn.cursor()
+        target_table = f"{SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{SNOWFLAKE_TABLE}"
 
-        # Construct the INSERT statement dynamically based on the keys in the first record
-        # This makes it more robust to changes in the data structure
-        columns = ", ".join(weather_records[0].keys())
-        placeholders = ", ".join([f"%({col})s" for col in weather_records[0].keys()])
-        insert_sql = f"INSERT INTO {SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{SNOWFLAKE_TABLE} ({columns}) VALUES ({placeholders})"
+        cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE {SNOWFLAKE_STAGE_TABLE} LIKE {target_table}")
+        success, _, staged_rows, _ = write_pandas(
+            conn, frame, SNOWFLAKE_STAGE_TABLE,
+            quote_identifiers=False, compression="snappy", use_logical_type=True
+        )
+        if not success:
+            raise RuntimeError(f"write_pandas staged {staged_rows} of {len(frame)} rows")
 
-        # Execute batch insert
-        cursor.executemany(insert_sql, weather_records)
+        # ingested_at is stamped by Snowflake (UTC) so the dashboard cache can pull deltas
+        # by load time, including rows whose record_timestamp is older (drained spool)
+        column_names = list(frame.columns)
+        columns = ", ".join(column_names)
+        source_columns = ", ".join(f"s.{column}" for column in column_names)
+        if "ingested_at" in table_columns:
+            columns += ", ingested_at"
+            source_columns += ", SYSDATE()"
+        if dedupe:
+            cursor.execute(f"""
+            MERGE INTO {target_table} t
+            USING (
+                SELECT * FROM {SNOWFLAKE_STAGE_TABLE}
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY location_name, last_updated_epoch ORDER BY record_timestamp) = 1
+            ) s
+            ON t.location_name = s.location_name AND t.last_updated_epoch = s.last_updated_epoch
+            WHEN NOT MATCHED THEN INSERT ({columns})
+            VALUES ({source_columns})
+            """)
+            insert_count = cursor.fetchone()[0] # MERGE reports the number of rows inserted first
+        else:
+            cursor.execute(
+                f"INSERT INTO {target_table} ({columns}) "
+                f"SELECT {source_columns} FROM {SNOWFLAKE_STAGE_TABLE} s"
+            )
+            insert_count = cursor.rowcount
 
         # Commit transaction
         conn.commit()
-
-        insert_count = len(weather_records)
-        logger.info(f"Inserted {insert_count} records into Snowflake table {SNOWFLAKE_TABLE}")
-
+        logger.info(f"Inserted {insert_count} of {len(frame)} records into Snowflake table {SNOWFLAKE_TABLE}")
         return insert_count
 
     except Exception as e:
@@ -381,3 +812,306 @@ def insert_to_snowflake(weather_records: List[Dict[str, Any]]) -> int:
         if conn:
             conn.close()
 
+def _store_key(key: str) -> str:
+    return f"{S3_STORE_PREFIX}{key}"
+
+def store_put(key: str, data: bytes):
+    """
+    Writes an object to the durable store (S3 if configured, else the local store directory).
+    """
+    if s3_client:
+        s3_client.put_object(Bucket=S3_STORE_BUCKET, Key=_store_key(key), Body=data)
+        return
+    path = Path(LOCAL_STORE_DIR) / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path) # Atomic, so readers never see a partial object
+
+def store_get(key: str) -> bytes | None:
+    """
+    Reads an object from the durable store, returning None if it does not exist.
+    """
+    if s3_client:
+        try:
+            return s3_client.get_object(Bucket=S3_STORE_BUCKET, Key=_store_key(key))["Body"].read()
+        except s3_client.exceptions.NoSuchKey:
+            return None
+    path = Path(LOCAL_STORE_DIR) / key
+    return path.read_bytes() if path.exists() else None
+
+def store_list(prefix: str) -> List[Tuple[str, int]]:
+    """
+    Lists (key, size_in_bytes) of the objects directly under a prefix (not in
+    nested prefixes such as spool/dead/), sorted by key.
+    """
+    entries = []
+    if s3_client:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=S3_STORE_BUCKET, Prefix=_store_key(prefix)):
+            for obj in page.get("Contents", []):
+                key = obj["Key"][len(S3_STORE_PREFIX):]
+                if "/" not in key[len(prefix):]:
+                    entries.append((key, obj["Size"]))
+    else:
+        directory = Path(LOCAL_STORE_DIR) / prefix
+        if directory.exists():
+            entries = [
+                (f"{prefix}{f.name}", f.stat().st_size) for f in directory.iterdir()
+                if f.is_file() and not f.name.endswith(".tmp")
+            ]
+    return sorted(entries)
+
+def store_delete(key: str):
+    """
+    Removes an object from the durable store.
+    """
+    if s3_client:
+        s3_client.delete_object(Bucket=S3_STORE_BUCKET, Key=_store_key(key))
+        return
+    path = Path(LOCAL_STORE_DIR) / key
+    if path.exists():
+        path.unlink()
+
+def spool_weather_records(weather_records: List[Dict[str, Any]]):
+    """
+    Saves a batch that could not be inserted as gzipped newline-delimited JSON,
+    then evicts the oldest batches until the spool is within its bounds.
+    """
+    if not weather_records:
+        return
+    # Zero-padded nanosecond prefix keeps keys in oldest-first order
+    key = f"{SPOOL_PREFIX}batch-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.ndjson.gz"
+    lines = "\n".join(json.dumps(record, default=lambda v: v.isoformat()) for record in weather_records)
+    try:
+        store_put(key, gzip.compress(lines.encode("utf-8")))
+        logger.info(f"Spooled {len(weather_records)} record(s) to {key}")
+
+        entries = store_list(SPOOL_PREFIX)
+        total_bytes = sum(size for _, size in entries)
+        while entries and (len(entries) > SPOOL_MAX_BATCHES or total_bytes > SPOOL_MAX_BYTES):
+            oldest_key, oldest_size = entries.pop(0)
+            store_delete(oldest_key)
+            total_bytes -= oldest_size
+            logger.warning(f"Spool over its bounds, evicted oldest batch {oldest_key}")
+    except Exception as e:
+        logger.error(f"Error spooling weather records: {str(e)}")
+
+def read_spooled_batch(key: str) -> List[Dict[str, Any]]:
+    """
+    Reads one spooled batch back into records.
+    """
+    lines = gzip.decompress(store_get(key)).decode("utf-8").splitlines()
+    records = [json.loads(line) for line in lines if line]
+    for record in records:
+        if record.get("record_timestamp"):
+            record["record_timestamp"] = datetime.fromisoformat(record["record_timestamp"])
+    return records
+
+def drain_spooled_batches(table_columns: Set[str]) -> Tuple[int, int]:
+    """
+    Inserts up to SPOOL_DRAIN_MAX_BATCHES spooled batches, oldest first, each in its
+    own transaction so one bad batch cannot hold back the others. A batch that cannot
+    be read, or fails SPOOL_MAX_ATTEMPTS inserts, is moved to spool/dead/.
+    Returns (batches drained, records inserted).
+    """
+    try:
+        entries = store_list(SPOOL_PREFIX)
+    except Exception as e:
+        logger.error(f"Error listing spooled batches: {str(e)}")
+        return 0, 0
+    if not entries:
+        return 0, 0
+
+    attempts = load_state("spool_attempts")
+    drained_batches = 0
+    drained_records = 0
+    for key, _ in entries[:SPOOL_DRAIN_MAX_BATCHES]:
+        try:
+            records = read_spooled_batch(key)
+        except Exception as e:
+            logger.error(f"Error reading spooled batch {key}: {str(e)}")
+            dead_letter_spooled_batch(key)
+            continue
+        try:
+            drained_records += load_frame_to_snowflake(records_to_frame(records), table_columns)
+            drained_batches += 1
+            delete_spooled_batch(key)
+        except Exception as e:
+            attempts[key] = attempts.get(key, 0) + 1
+            logger.error(f"Error inserting spooled batch {key} (attempt {attempts[key]}): {str(e)}")
+            if attempts[key] >= SPOOL_MAX_ATTEMPTS:
+                dead_letter_spooled_batch(key)
+
+    remaining_keys = {key for key, _ in store_list(SPOOL_PREFIX)}
+    save_state("spool_attempts", {key: count for key, count in attempts.items() if key in remaining_keys})
+    return drained_batches, drained_records
+
+def dead_letter_spooled_batch(key: str):
+    """
+    Moves a spooled batch that keeps failing to spool/dead/ so it stops being retried,
+    keeping at most SPOOL_MAX_DEAD_BATCHES dead batches.
+    """
+    dead_key = f"{SPOOL_DEAD_PREFIX}{key[len(SPOOL_PREFIX):]}"
+    try:
+        store_put(dead_key, store_get(key))
+        store_delete(key)
+        logger.warning(f"Moved spooled batch {key} to {dead_key}")
+
+        dead_entries = store_list(SPOOL_DEAD_PREFIX)
+        for oldest_key, _ in dead_entries[:max(len(dead_entries) - SPOOL_MAX_DEAD_BATCHES, 0)]:
+            store_delete(oldest_key)
+            logger.warning(f"Dead-letter spool over its bounds, evicted oldest batch {oldest_key}")
+    except Exception as e:
+        logger.error(f"Error moving spooled batch {key} to {dead_key}: {str(e)}")
+
+def delete_spooled_batch(key: str):
+    """
+    Removes a spooled batch once it has been written to Snowflake.
+    """
+    try:
+        store_delete(key)
+    except Exception as e:
+        logger.error(f"Error deleting spooled batch {key}: {str(e)}")
+
+def load_state(name: str) -> Dict[str, Any]:
+    """
+    Loads a small JSON state document from the durable store ({} if missing or unreadable).
+    """
+    try:
+        data = store_get(f"{STATE_PREFIX}{name}.json")
+        return json.loads(data) if data else {}
+    except Exception as e:
+        logger.error(f"Error loading state {name}: {str(e)}")
+        return {}
+
+def save_state(name: str, state: Dict[str, Any], required: bool = False):
+    """
+    Saves a small JSON state document to the durable store. Errors are logged, and
+    re-raised when `required` (e.g. backfill checkpoints, which must not be lost).
+    """
+    try:
+        store_put(f"{STATE_PREFIX}{name}.json", json.dumps(state).encode("utf-8"))
+    except Exception as e:
+        logger.error(f"Error saving state {name}: {str(e)}")
+        if required:
+            raise
+
+def run_backfill(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Loads hourly history for a set of cities and a date range.
+
+    Expected event: {"mode": "backfill", "start_date": "YYYY-MM-DD", "end_date": "YYYY-MM-DD",
+    "backfill_id": "..." (optional)} plus an optional city scope as accepted by select_cities.
+    The work is split into (city, day) tasks fetched in parallel under the API rate limiter.
+    Every chunk is transformed column-wise, merged into Snowflake and then checkpointed, so invoking again with the same
+    event resumes where an interrupted or timed-out run stopped. A failed checkpoint stops the run; the chunk
+    is fetched again on resume and the MERGE skips the rows that were already loaded.
+    """
+    try:
+        start_date = date.fromisoformat(event["start_date"])
+        end_date = date.fromisoformat(event.get("end_date", event["start_date"]))
+        if end_date < start_date:
+            raise ValueError(f"end_date {end_date} is before start_date {start_date}")
+    except (KeyError, TypeError, ValueError) as e:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"message": f"Invalid backfill request, expected start_date/end_date as YYYY-MM-DD: {str(e)}"})
+        }
+    try:
+        cities = select_cities(event)
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"message": f"Invalid city scope: {str(e)}"})
+        }
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+
+    cities_hash = hashlib.sha1(",".join(cities).encode("utf-8")).hexdigest()[:8]
+    backfill_id = event.get("backfill_id") or f"{start_date}_{end_date}_{cities_hash}"
+    checkpoint_name = f"backfill/{backfill_id}"
+    completed = set(load_state(checkpoint_name).get("completed", []))
+    tasks = [(city, day) for city in cities for day in days if f"{city}|{day}" not in completed]
+    logger.info(f"Backfill {backfill_id}: {len(tasks)} pending task(s), {len(completed)} already completed.")
+
+    try:
+        table_columns = ensure_snowflake_table_exists()
+    except Exception as e:
+        logger.error(f"Failed to ensure Snowflake table exists: {str(e)}")
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"message": f"Failed to initialize Snowflake table: {str(e)}"})
+        }
+
+    total_records_inserted = 0
+    failed_tasks = []
+    status_code = 200
+    message = "Backfill complete."
+    chunk_start = 0
+    with ThreadPoolExecutor(max_workers=BACKFILL_MAX_WORKERS) as executor:
+        while chunk_start < len(tasks):
+            chunk_size = backfill_chunk_size(context)
+            if chunk_size == 0:
+                message = "Backfill paused before the Lambda timeout; invoke again with the same event to resume."
+                break
+            chunk = tasks[chunk_start:chunk_start + chunk_size]
+            chunk_start += len(chunk)
+            results = list(executor.map(lambda task: fetch_backfill_task(*task), chunk))
+
+            chunk_payloads = []
+            chunk_completed = []
+            for (city, day), task_payloads in zip(chunk, results):
+                if task_payloads is None:
+                    failed_tasks.append(f"{city}|{day}") # Not checkpointed, so retried on the next run
+                    continue
+                chunk_payloads.extend(task_payloads)
+                chunk_completed.append(f"{city}|{day}")
+
+            if chunk_payloads:
+                try:
+                    chunk_frame = columns_to_frame(payloads_to_columns(chunk_payloads))
+                    total_records_inserted += load_frame_to_snowflake(chunk_frame, table_columns, dedupe=True)
+                except Exception as e:
+                    logger.error(f"Error inserting backfill chunk to Snowflake: {str(e)}")
+                    status_code = 500
+                    message = f"Backfill stopped, failed to insert to Snowflake: {str(e)}."
+                    break
+
+            try:
+                save_state(checkpoint_name, {"completed": sorted(completed | set(chunk_completed))}, required=True)
+            except Exception as e:
+                status_code = 500
+                message = f"Backfill stopped, failed to save the checkpoint: {str(e)}."
+                break
+            completed.update(chunk_completed)
+        else:
+            if failed_tasks:
+                message = "Backfill finished with failed task(s); invoke again with the same event to retry them."
+
+    return {
+        "statusCode": status_code,
+        "body": json.dumps({
+            "message": message,
+            "backfill_id": backfill_id,
+            "records_inserted": total_records_inserted,
+            "tasks_completed": len(completed),
+            "tasks_remaining": len(cities) * len(days) - len(completed),
+            "tasks_failed": failed_tasks,
+            "timestamp": datetime.utcnow().isoformat()
+        })
+    }
+
+def backfill_chunk_size(context: Any) -> int:
+    """
+    Returns how many (city, day) tasks the next chunk can take (up to BACKFILL_CHUNK_SIZE)
+    so that it finishes before the Lambda times out: every round of BACKFILL_MAX_WORKERS
+    requests is budgeted the full API timeout plus the rate limiter's spacing, and
+    BACKFILL_TIME_RESERVE_MS is kept for the load and checkpoint. 0 means pause.
+    """
+    if not context:
+        return BACKFILL_CHUNK_SIZE
+    round_ms = WEATHER_API_TIMEOUT_SECONDS * 1000
+    if WEATHER_API_RATE_LIMIT_PER_SEC > 0:
+        round_ms += BACKFILL_MAX_WORKERS * 1000 / WEATHER_API_RATE_LIMIT_PER_SEC
+    rounds = int((context.get_remaining_time_in_millis() - BACKFILL_TIME_RESERVE_MS) // round_ms)
+    return max(0, min(BACKFILL_CHUNK_SIZE, rounds * BACKFILL_MAX_WORKERS))
@@ -0,0 +1,223 @@
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError: # Windows: refreshes are not serialized across sessions
+    fcntl = None
+
+# --- Configuration ---
+# Local columnar cache of the WEATHER_DATA table, partitioned by record date:
+#   <WEATHER_CACHE_DIR>/RECORD_DATE=YYYY-MM-DD/part-<unix_ms>.parquet
+WEATHER_CACHE_DIR = Path(os.environ.get("WEATHER_CACHE_DIR", ".weather_cache"))
+WEATHER_CACHE_RETENTION_DAYS = int(os.environ.get("WEATHER_CACHE_RETENTION_DAYS", "90")) # Partitions older than this are dropped
+WEATHER_CACHE_REFRESH_SECONDS = int(os.environ.get("WEATHER_CACHE_REFRESH_SECONDS", "300")) # Minimum gap between delta pulls
+WEATHER_CACHE_COMPACT_FILES = int(os.environ.get("WEATHER_CACHE_COMPACT_FILES", "8")) # Merge a partition once it has this many files
+WEATHER_CACHE_OVERLAP_MINUTES = int(os.environ.get("WEATHER_CACHE_OVERLAP_MINUTES", "15")) # Re-read window for rows committed out of order
+
+TIMESTAMP_COLUMN = "RECORD_TIMESTAMP"
+# Set by the Lambda at insert time. Deltas are pulled by ingestion time rather than
+# RECORD_TIMESTAMP, because drained spool batches keep their original RECORD_TIMESTAMP.
+WATERMARK_COLUMN = "INGESTED_AT"
+DEDUPE_COLUMNS = ["LOCATION_NAME", TIMESTAMP_COLUMN, WATERMARK_COLUMN]
+REFRESH_MARKER = ".last_refresh"
+WATERMARK_FILE = ".watermark"
+FILES_LOCK = ".files.lock" # Shared by readers, exclusive while files are written or removed
+REFRESH_LOCK = ".refresh.lock" # Lets one session at a time pull a delta from Snowflake
+READ_ATTEMPTS = 3
+
+
+def _partition_dirs() -> List[Path]:
+    if not WEATHER_CACHE_DIR.exists():
+        return []
+    return sorted(p for p in WEATHER_CACHE_DIR.glob("RECORD_DATE=*") if p.is_dir())
+
+
+def _partition_files() -> List[Path]:
+    return [f for p in _partition_dirs() for f in sorted(p.glob("*.parquet"))]
+
+
+@contextmanager
+def _cache_lock(lock_name: str, shared: bool = False):
+    """
+    Advisory file lock inside the cache directory, shared or exclusive.
+    Not re-entrant, so code holding a lock must not take the same one again.
+    """
+    WEATHER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(WEATHER_CACHE_DIR / lock_name, "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_cache() -> pd.DataFrame:
+    """
+    Reads the whole cache into a DataFrame. Files are memory-mapped so repeated
+    reads of an unchanged cache are served from the OS page cache.
+    """
+    with _cache_lock(FILES_LOCK, shared=True):
+        return _read_cache_files()
+
+
+def _read_cache_files() -> pd.DataFrame:
+    # Without fcntl nothing stops a compaction from removing files mid-read; start
+    # over from a fresh listing when that happens.
+    for attempt in range(READ_ATTEMPTS):
+        files = _partition_files()
+        if not files:
+            return pd.DataFrame()
+        try:
+            frames = [pd.read_parquet(f, engine="pyarrow", memory_map=True) for f in files]
+        except FileNotFoundError:
+            if attempt == READ_ATTEMPTS - 1:
+                raise
+            continue
+        df = pd.concat(frames, ignore_index=True)
+        if TIMESTAMP_COLUMN in df.columns:
+            df = df.sort_values(TIMESTAMP_COLUMN, kind="stable").reset_index(drop=True)
+        return df
+
+
+def _read_watermark() -> Optional[pd.Timestamp]:
+    path = WEATHER_CACHE_DIR / WATERMARK_FILE
+    if not path.exists():
+        return None
+    return pd.Timestamp(path.read_text().strip())
+
+
+def _write_watermark(watermark: pd.Timestamp):
+    tmp_path = WEATHER_CACHE_DIR / (WATERMARK_FILE + ".tmp")
+    tmp_path.write_text(watermark.isoformat())
+    tmp_path.replace(WEATHER_CACHE_DIR / WATERMARK_FILE)
+
+
+def _row_keys(df: pd.DataFrame) -> pd.MultiIndex:
+    keys = df[DEDUPE_COLUMNS].copy()
+    for column in (TIMESTAMP_COLUMN, WATERMARK_COLUMN):
+        keys[column] = pd.to_datetime(keys[column])
+    return pd.MultiIndex.from_frame(keys)
+
+
+def _clear_cache():
+    for partition in _partition_dirs():
+        for f in partition.iterdir():
+            f.unlink()
+        partition.rmdir()
+
+
+def write_delta(delta: pd.DataFrame) -> int:
+    """
+    Appends newly fetched rows to the cache, one file per touched date partition.
+    Files are written under a temporary name and renamed, so readers never see a partial file.
+    """
+    if delta is None or delta.empty or TIMESTAMP_COLUMN not in delta.columns:
+        return 0
+    delta = delta.copy()
+    delta[TIMESTAMP_COLUMN] = pd.to_datetime(delta[TIMESTAMP_COLUMN])
+    part_name = f"part-{int(time.time() * 1000)}.parquet"
+    for record_date, rows in delta.groupby(delta[TIMESTAMP_COLUMN].dt.strftime("%Y-%m-%d")):
+        partition = WEATHER_CACHE_DIR / f"RECORD_DATE={record_date}"
+        partition.mkdir(parents=True, exist_ok=True)
+        tmp_path = partition / (part_name + ".tmp")
+        rows.to_parquet(tmp_path, engine="pyarrow", index=False)
+        tmp_path.rename(partition / part_name)
+    return len(delta)
+
+
+def enforce_retention():
+    """
+    Drops whole date partitions that fall outside the retention window.
+    """
+    cutoff = (datetime.utcnow() - timedelta(days=WEATHER_CACHE_RETENTION_DAYS)).strftime("%Y-%m-%d")
+    for partition in _partition_dirs():
+        if partition.name.split("=", 1)[1] < cutoff:
+            for f in partition.iterdir():
+                f.unlink()
+            partition.rmdir()
+
+
+def compact_partitions():
+    """
+    Rewrites partitions that have accumulated many small delta files as a single
+    file under a new name, then removes the originals.
+    """
+    for partition in _partition_dirs():
+        files = sorted(partition.glob("*.parquet"))
+        if len(files) < WEATHER_CACHE_COMPACT_FILES:
+            continue
+        merged = pd.concat([pd.read_parquet(f, engine="pyarrow") for f in files], ignore_index=True)
+        merged = merged.drop_duplicates().sort_values(TIMESTAMP_COLUMN, kind="stable")
+        compacted_name = f"part-{int(time.time() * 1000)}-compacted.parquet"
+        tmp_path = partition / (compacted_name + ".tmp")
+        merged.to_parquet(tmp_path, engine="pyarrow", index=False)
+        tmp_path.rename(partition / compacted_name)
+        for f in files:
+            f.unlink()
+
+
+def _refresh_due() -> bool:
+    marker = WEATHER_CACHE_DIR / REFRESH_MARKER
+    if not marker.exists():
+        return True
+    return time.time() - marker.stat().st_mtime >= WEATHER_CACHE_REFRESH_SECONDS
+
+
+def refresh_cache(table: str, run_query: Callable[[str], Optional[pd.DataFrame]]) -> int:
+    """
+    Pulls the rows ingested since the watermark (minus an overlap window for
+    transactions that committed out of order) from Snowflake, drops the ones the cache
+    already has, then applies the retention and compaction policy. Without a
+    watermark (new cache, or no INGESTED_AT values yet) the cache is rebuilt from a
+    full read. Returns the number of rows added. Call with REFRESH_LOCK held.
+    """
+    watermark = _read_watermark()
+    query = f"SELECT * FROM {table}"
+    overlap_start = None
+    if watermark is not None:
+        overlap_start = watermark - timedelta(minutes=WEATHER_CACHE_OVERLAP_MINUTES)
+        query += f" WHERE {WATERMARK_COLUMN} > '{overlap_start.strftime('%Y-%m-%d %H:%M:%S.%f')}'::TIMESTAMP_NTZ"
+    delta = run_query(query)
+    if delta is None: # Query failed, keep serving what we have
+        return 0
+
+    with _cache_lock(FILES_LOCK):
+        if watermark is None:
+            _clear_cache()
+        elif not delta.empty and all(column in delta.columns for column in DEDUPE_COLUMNS):
+            cached = _read_cache_files()
+            if not cached.empty:
+                cached = cached[pd.to_datetime(cached[WATERMARK_COLUMN]) > overlap_start]
+                delta = delta[~_row_keys(delta).isin(_row_keys(cached))]
+
+        added = write_delta(delta)
+        if WATERMARK_COLUMN in delta.columns and delta[WATERMARK_COLUMN].notna().any():
+            latest = pd.Timestamp(pd.to_datetime(delta[WATERMARK_COLUMN]).max())
+            _write_watermark(max(latest, watermark) if watermark is not None else latest)
+        enforce_retention()
+        compact_partitions()
+    (WEATHER_CACHE_DIR / REFRESH_MARKER).touch()
+    return added
+
+
+def load_weather_history(table: str, run_query: Callable[[str], Optional[pd.DataFrame]], force_refresh: bool = False) -> pd.DataFrame:
+    """
+    Returns the cached history of `table`, contacting Snowflake for deltas only
+    when the cache is stale (or when forced, e.g. right after a Lambda run).
+    Concurrent sessions take turns refreshing; a session that waited for another
+    one's refresh does not repeat it unless forced.
+    """
+    if force_refresh or _refresh_due():
+        with _cache_lock(REFRESH_LOCK):
+            if force_refresh or _refresh_due():
+                refresh_cache(table, run_query)
+    return read_cache()
@@ -0,0 +1,220 @@
+from datetime import datetime
+from itertools import repeat
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Single source of truth for the WEATHER_DATA schema: raw WeatherAPI payloads go straight
+# into typed NumPy masked arrays (mask = value missing), one per Snowflake column, and the
+# Lambda creates the table from the same specs. Each column is gathered into a list and
+# converted in one np.array call. The columns are loaded into Snowflake as a DataFrame
+# (Parquet), so no per-row Python objects are built on the insert path.
+
+STR, FLOAT, INT = "str", "float", "int"
+BOOL, TIMESTAMP = "bool", "timestamp" # Kinds of is_day and record_timestamp once transformed
+
+# (column, payload section, key, kind, Snowflake type), in the order of the Snowflake table
+COLUMN_SPECS = [
+    ("location_name", "location", "name", STR, "VARCHAR"),
+    ("location_region", "location", "region", STR, "VARCHAR"),
+    ("location_country", "location", "country", STR, "VARCHAR"),
+    ("location_lat", "location", "lat", FLOAT, "FLOAT"),
+    ("location_lon", "location", "lon", FLOAT, "FLOAT"),
+    ("localtime_epoch", "location", "localtime_epoch", INT, "BIGINT"),
+    ("localtime_str", "location", "localtime", STR, "VARCHAR"),
+    ("last_updated_epoch", "current", "last_updated_epoch", INT, "BIGINT"),
+    ("last_updated_str", "current", "last_updated", STR, "VARCHAR"),
+    ("temp_c", "current", "temp_c", FLOAT, "FLOAT"),
+    ("temp_f", "current", "temp_f", FLOAT, "FLOAT"),
+    ("is_day", "current", "is_day", INT, "BOOLEAN"), # 1/0 from the API, stored as True/False
+    ("condition_text", "condition", "text", STR, "VARCHAR"),
+    ("condition_icon", "condition", "icon", STR, "VARCHAR"),
+    ("condition_code", "condition", "code", INT, "INTEGER"),
+    ("wind_kph", "current", "wind_kph", FLOAT, "FLOAT"),
+    ("wind_mph", "current", "wind_mph", FLOAT, "FLOAT"),
+    ("wind_degree", "current", "wind_degree", INT, "INTEGER"),
+    ("wind_dir", "current", "wind_dir", STR, "VARCHAR"),
+    ("pressure_mb", "current", "pressure_mb", FLOAT, "FLOAT"),
+    ("pressure_in", "current", "pressure_in", FLOAT, "FLOAT"),
+    ("precip_mm", "current", "precip_mm", FLOAT, "FLOAT"),
+    ("precip_in", "current", "precip_in", FLOAT, "FLOAT"),
+    ("humidity", "current", "humidity", INT, "INTEGER"),
+    ("cloud", "current", "cloud", INT, "INTEGER"),
+    ("feelslike_c", "current", "feelslike_c", FLOAT, "FLOAT"),
+    ("feelslike_f", "current", "feelslike_f", FLOAT, "FLOAT"),
+    ("vis_km", "current", "vis_km", FLOAT, "FLOAT"),
+    ("vis_miles", "current", "vis_miles", FLOAT, "FLOAT"),
+    ("uv", "current", "uv", FLOAT, "FLOAT"),
+    ("gust_kph", "current", "gust_kph", FLOAT, "FLOAT"),
+    ("gust_mph", "current", "gust_mph", FLOAT, "FLOAT"),
+]
+
+# Columns not taken from the payload, in table order: set by payloads_to_columns
+# (record_timestamp), by the Lambda (anomaly_flags) and by Snowflake on insert (ingested_at).
+# The last two were added after the table was first created.
+EXTRA_COLUMNS = [
+    ("record_timestamp", "TIMESTAMP_NTZ"),
+    ("anomaly_flags", "VARCHAR"),
+    ("ingested_at", "TIMESTAMP_NTZ"),
+]
+ADDED_COLUMNS = ["anomaly_flags", "ingested_at"]
+
+TABLE_COLUMNS = [(name, sql_type) for name, _, _, _, sql_type in COLUMN_SPECS] + EXTRA_COLUMNS
+
+# (target, source, scale, offset): target = source * scale + offset where target is missing,
+# rounded to two decimals like the API's own values
+UNIT_CONVERSIONS = [
+    ("temp_f", "temp_c", 1.8, 32.0),
+    ("temp_c", "temp_f", 1 / 1.8, -32.0 / 1.8),
+    ("feelslike_f", "feelslike_c", 1.8, 32.0),
+    ("feelslike_c", "feelslike_f", 1 / 1.8, -32.0 / 1.8),
+    ("wind_mph", "wind_kph", 1 / 1.609344, 0.0),
+    ("wind_kph", "wind_mph", 1.609344, 0.0),
+    ("gust_mph", "gust_kph", 1 / 1.609344, 0.0),
+    ("gust_kph", "gust_mph", 1.609344, 0.0),
+    ("vis_miles", "vis_km", 1 / 1.609344, 0.0),
+    ("vis_km", "vis_miles", 1.609344, 0.0),
+    ("pressure_in", "pressure_mb", 0.0295300, 0.0),
+    ("pressure_mb", "pressure_in", 1 / 0.0295300, 0.0),
+    ("precip_in", "precip_mm", 1 / 25.4, 0.0),
+    ("precip_mm", "precip_in", 25.4, 0.0),
+]
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan # Malformed values end up masked
+
+
+def _build_column(values: List[Any], kind: str) -> np.ma.MaskedArray:
+    """
+    Converts one column's raw values (None = missing) into a masked array.
+    Numbers go through a single float64 conversion; only a column holding a
+    malformed value falls back to converting element by element. INT columns mask
+    values that are not whole numbers (e.g. a humidity of 1.7) instead of truncating.
+    Columns are always 1-D, even when every value is a list of the same length.
+    """
+    n = len(values)
+    if kind == STR:
+        data = np.fromiter(values, dtype=object, count=n)
+        if set(map(type, values)) <= {str, type(None)}:
+            return np.ma.masked_array(data, mask=np.equal(data, None))
+        return np.ma.masked_array(data, mask=np.fromiter((not isinstance(value, str) for value in values), dtype=bool, count=n))
+    try:
+        data = np.array(values, dtype=float) # None becomes NaN
+    except (TypeError, ValueError):
+        data = None
+    if data is None or data.shape != (n,):
+        data = np.array([_to_float(value) for value in values], dtype=float)
+    mask = np.isnan(data)
+    if kind == FLOAT:
+        return np.ma.masked_array(data, mask=mask)
+    mask |= np.not_equal(data, np.floor(data))
+    return np.ma.masked_array(np.where(mask, 0, data).astype(np.int64), mask=mask)
+
+
+def payloads_to_columns(payloads: Sequence[Dict[str, Any]], record_timestamp: datetime | None = None) -> Dict[str, np.ma.MaskedArray]:
+    """
+    Builds one masked array per Snowflake column from raw current.json-style payloads.
+
+    Missing or malformed values are masked (NULL in Snowflake), unit pairs such as
+    temp_c/temp_f fill each other where only one side is present, and is_day becomes a
+    boolean column.
+    """
+    n = len(payloads)
+    currents = [payload.get("current") or {} for payload in payloads]
+    sections = {
+        "location": [payload.get("location") or {} for payload in payloads],
+        "current": currents,
+        "condition": [current.get("condition") or {} for current in currents]
+    }
+    columns = {
+        name: _build_column(list(map(dict.get, sections[section], repeat(key, n))), kind)
+        for name, section, key, kind, _ in COLUMN_SPECS
+    }
+
+    for target, source, scale, offset in UNIT_CONVERSIONS:
+        fill = np.ma.getmaskarray(columns[target]) & ~np.ma.getmaskarray(columns[source])
+        if fill.any():
+            columns[target].data[fill] = np.round(columns[source].data[fill] * scale + offset, 2)
+            columns[target].mask[fill] = False
+
+    is_day = columns["is_day"]
+    columns["is_day"] = np.ma.masked_array(~np.ma.getmaskarray(is_day) & (is_day.data == 1), mask=np.zeros(n, dtype=bool))
+    timestamps = np.full(n, np.datetime64(record_timestamp or datetime.utcnow(), "us"))
+    columns["record_timestamp"] = np.ma.masked_array(timestamps, mask=np.zeros(n, dtype=bool))
+    return columns
+
+
+def columns_to_frame(columns: Dict[str, np.ma.MaskedArray]) -> pd.DataFrame:
+    """
+    Wraps the columns in a DataFrame for write_pandas without going through rows.
+    Masked entries become NULLs: nullable Int64/boolean arrays, NaN, NaT or None.
+    """
+    data = {}
+    for name, column in columns.items():
+        mask = np.ma.getmaskarray(column)
+        if not mask.any():
+            data[name] = column.data
+        elif column.dtype == np.int64:
+            data[name] = pd.arrays.IntegerArray(column.data, mask.copy())
+        elif column.dtype == np.bool_:
+            data[name] = pd.arrays.BooleanArray(column.data, mask.copy())
+        elif column.dtype == np.float64:
+            data[name] = np.where(mask, np.nan, column.data)
+        elif column.dtype.kind == "M":
+            data[name] = np.where(mask, np.datetime64("NaT"), column.data)
+        else:
+            values = column.data.copy()
+            values[mask] = None
+            data[name] = values
+    return pd.DataFrame(data)
+
+
+def records_to_frame(records: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Rebuilds the DataFrame of a spooled batch (per-row dicts keyed by column name),
+    typing each column like payloads_to_columns does.
+    """
+    kinds = {name: kind for name, _, _, kind, _ in COLUMN_SPECS}
+    kinds.update({"is_day": BOOL, "record_timestamp": TIMESTAMP})
+    columns = {}
+    for name in dict.fromkeys(key for record in records for key in record):
+        values = [record.get(name) for record in records]
+        kind = kinds.get(name, STR)
+        if kind == BOOL:
+            columns[name] = np.ma.masked_array(np.array([value is True for value in values]), mask=np.equal(values, None))
+        elif kind == TIMESTAMP:
+            columns[name] = np.ma.masked_array(np.array(values, dtype="datetime64[us]"), mask=np.equal(values, None))
+        else:
+            columns[name] = _build_column(values, kind)
+    return columns_to_frame(columns)
+
+
+def columns_to_rows(columns: Dict[str, np.ma.MaskedArray], column_names: List[str] | None = None) -> Tuple[List[str], List[tuple]]:
+    """
+    Converts columns into (column_names, row tuples). Masked entries become None;
+    columns not present yield None.
+    """
+    column_names = column_names or list(columns)
+    n = len(next(iter(columns.values()))) if columns else 0
+    return column_names, list(zip(*(_column_values(columns[name]) if name in columns else [None] * n for name in column_names)))
+
+
+def _column_values(column: np.ma.MaskedArray) -> List[Any]:
+    mask = np.ma.getmaskarray(column)
+    if not mask.any():
+        return column.data.tolist()
+    values = column.data.astype(object) # Python scalars, with room for None
+    values[mask] = None
+    return values.tolist()
+
+
+def columns_to_records(columns: Dict[str, np.ma.MaskedArray]) -> List[Dict[str, Any]]:
+    """
+    Converts columns back into per-row dicts (used only to spool failed batches).
+    """
+    column_names, rows = columns_to_rows(columns)
+    return [dict(zip(column_names, row)) for row in rows]